@@ -0,0 +1,758 @@
+"""
+Quantiphyse - Numba implementation of the DCE Pk modelling fit
+
+This is a port of the C++ code in ``src/`` (the Tofts model with Orton or
+Weinmann population AIFs, fitted using bounded Levenberg-Marquardt) which
+compiles to native code and fits voxels in parallel.
+
+The Levenberg-Marquardt fit is a port of ``lm_lmdif`` from ``src/lmlib``
+with the same controls, bound penalty and model expressions, so it follows
+the same path as the C++ code. The tests in ``tests/`` check that the fitted
+parameters and residuals agree with the C++ code for all four models on
+synthetic data generated from the model and on data which is not.
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+
+import math
+import functools
+
+import numpy as np
+from numba import njit, prange, literally, config
+
+try:
+    from numba import cuda
+except ImportError:
+    cuda = None
+
+#: Number of parameters in the output: Ktrans, ve, offset, vp
+N_PARAMS = 4
+
+#: Log description, number of fitted parameters and population AIF for each
+#: model choice. AIF parameters are (a1, a2, m1, m2) as in Pkrun2::rinit
+MODELS = {
+    1 : ("Orton with offset (Clinical)", 3, (2.65, 1.51, 22.40, 0.23)),
+    2 : ("Orton without offset (Clinical)", 2, (2.65, 1.51, 22.40, 0.23)),
+    3 : ("Weinmann with offset (Pre-clinical)", 3, (9.2, 4.2, 2.3, 0.05)),
+    4 : ("Weinmann with offset and vp (Pre-clinical)", 4, (9.2, 4.2, 2.3, 0.05)),
+}
+
+# Value of pi used in the C++ model functions
+_PI = 3.14159265
+
+# Machine constants, as in lmmin
+_MACHEP = np.finfo(np.float64).eps
+_DWARF = np.finfo(np.float64).tiny
+_SQRT_DWARF = math.sqrt(_DWARF)
+_SQRT_GIANT = math.sqrt(np.finfo(np.float64).max)
+
+# Levenberg-Marquardt controls, matching lm_control_double in lmmin. The
+# function evaluations are limited to _MAX_CALL * (number of parameters + 1)
+_TOL = 30 * _MACHEP
+_FD_STEP = math.sqrt(_TOL)
+_MAX_CALL = 100
+_STEP_BOUND = 100.0
+
+# No fast math so the floating point operations, and hence the path taken by the
+# fit, are the same as in the C++ code. Division by zero gives inf/nan as in the
+# C++ code rather than raising
+_JIT_OPTIONS = {
+    "error_model" : "numpy",
+    "cache" : True,
+}
+
+@njit(**_JIT_OPTIONS)
+def _max(a, b):
+    """
+    Maximum, as the MAX macro in lmmin. Used instead of the max builtin, which also
+    does not compile for CUDA devices
+    """
+    return a if a >= b else b
+
+@njit(**_JIT_OPTIONS)
+def _min(a, b):
+    """
+    Minimum, as the MIN macro in lmmin
+    """
+    return a if a <= b else b
+
+@njit(**_JIT_OPTIONS)
+def _orton_f(time1, alpha, m1):
+    """
+    Orton subfunction
+    """
+    return (1/alpha) * (1 - math.exp(-alpha*time1)) - (1/(alpha*alpha + m1*m1)) * (
+        alpha*math.cos(m1*time1) + m1*math.sin(m1*time1) - alpha*math.exp(-alpha*time1))
+
+@njit(**_JIT_OPTIONS)
+def _ct_orton(aif, ktrans, kep, time1, offset_pk):
+    """
+    Gd concentration using the Orton AIF
+    """
+    a1, a2, m1, m2 = aif[0], aif[1], aif[2], aif[3]
+    time1 = time1 - aif[4] - offset_pk
+    if time1 < 0:
+        time1 = 0.0
+    t_b = aif[5]
+
+    tmp1 = (a1*a2*ktrans) / (kep-m2)
+    tmp2 = ((kep-m2)/a2) - 1
+    if time1 <= t_b:
+        return tmp1 * (_orton_f(time1, m2, m1) + tmp2*_orton_f(time1, kep, m1))
+    else:
+        return tmp1 * (aif[6] * math.exp(-m2*(time1-t_b)) +
+                       tmp2 * _orton_f(t_b, kep, m1) * math.exp(-kep*(time1-t_b)))
+
+@njit(**_JIT_OPTIONS)
+def _ct_weinmann(aif, ktrans, kep, time1, offset_pk, vp, dose):
+    """
+    Gd concentration using the Weinmann AIF, including the vp*Cp term of the extended Tofts model
+    """
+    a1, a2, m1, m2 = aif[0], aif[1], aif[2], aif[3]
+    time1 = time1 - aif[4] - offset_pk
+    if time1 < 0:
+        return 0.0
+
+    cp = dose * (a1*math.exp(-m1*time1) + a2*math.exp(-m2*time1))
+    return dose*ktrans * ((a1/(m1-kep)) * (math.exp(-time1*kep) - math.exp(-time1*m1)) +
+                          (a2/(m2-kep)) * (math.exp(-time1*kep) - math.exp(-time1*m2))) + vp*cp
+
+@njit(**_JIT_OPTIONS)
+def _se_from_conc(ct, p10, scan):
+    """
+    Signal enhancement from Gd concentration
+
+    ``p10`` is TR/T10 for the voxel. ``scan`` is as returned by ``_run_constants``.
+    The expressions are evaluated as in the C++ code so the results are identical
+    """
+    r1, r2, tr, te, cos_alpha = scan[0], scan[1], scan[3], scan[4], scan[6]
+    q = r1 * ct * tr
+    e10 = math.exp(-p10)
+    e1 = math.exp(-p10 - q)
+    e2 = math.exp(-2*p10 - q)
+
+    a = math.exp(-r2 * ct * te)
+    b = 1 - e1 - (cos_alpha * (e10 - e2))
+    c = 1 - e10 - (cos_alpha * (e1 - e2))
+    return a * (b/c) - 1
+
+@njit(**_JIT_OPTIONS)
+def _signal(model, time1, par, p10, aif, scan):
+    """
+    Model signal enhancement at a single time point
+    """
+    ktrans, ve = par[0], par[1]
+    kep = ktrans / ve
+    if model == 1:
+        ct = _ct_orton(aif, ktrans, kep, time1, par[2])
+    elif model == 2:
+        ct = _ct_orton(aif, ktrans, kep, time1, 0.0)
+    elif model == 3:
+        ct = _ct_weinmann(aif, ktrans, kep, time1, par[2], 0.0, scan[5])
+    else:
+        ct = _ct_weinmann(aif, ktrans, kep, time1, par[2], par[3], scan[5])
+    return _se_from_conc(ct, p10, scan)
+
+@njit(**_JIT_OPTIONS)
+def _tofts_residual(model, n_fit, time1, y, par, p10, aif, scan, ub, lb):
+    """
+    Residual at a single time point, with the out-of-bounds penalty used by lmcurve_evaluate_var_bound
+    """
+    res = y - _signal(model, time1, par, p10, aif, scan)
+    for j in range(n_fit):
+        if par[j] > ub[j]:
+            res = res * (par[j]-ub[j]+1) * (par[j]-ub[j]+1)
+        if par[j] < lb[j]:
+            res = res * (-par[j]+lb[j]+1) * (-par[j]+lb[j]+1)
+    return res
+
+@njit(**_JIT_OPTIONS)
+def _evaluate(model, n_fit, times, y, par, p10, aif, scan, ub, lb, fvec):
+    """
+    Residuals at all time points, as lmcurve_evaluate_var_bound
+    """
+    for i in range(times.shape[0]):
+        fvec[i] = _tofts_residual(model, n_fit, times[i], y[i], par, p10, aif, scan, ub, lb)
+
+@njit(**_JIT_OPTIONS)
+def _enorm(x):
+    """
+    Euclidean norm avoiding destructive underflow and overflow, as lm_enorm
+    """
+    s1, s2, s3 = 0.0, 0.0, 0.0
+    x1max, x3max = 0.0, 0.0
+    agiant = _SQRT_GIANT / x.shape[0]
+    for i in range(x.shape[0]):
+        xabs = abs(x[i])
+        if xabs > _SQRT_DWARF:
+            if xabs < agiant:
+                s2 += xabs * xabs
+            elif xabs > x1max:
+                temp = x1max / xabs
+                s1 = 1 + s1 * temp * temp
+                x1max = xabs
+            else:
+                temp = xabs / x1max
+                s1 += temp * temp
+        elif xabs > x3max:
+            temp = x3max / xabs
+            s3 = 1 + s3 * temp * temp
+            x3max = xabs
+        elif xabs != 0:
+            temp = xabs / x3max
+            s3 += temp * temp
+
+    if s1 != 0:
+        return x1max * math.sqrt(s1 + (s2 / x1max) / x1max)
+    elif s2 != 0:
+        if s2 >= x3max:
+            return math.sqrt(s2 * (1 + (x3max / s2) * (x3max * s3)))
+        else:
+            return math.sqrt(x3max * ((s2 / x3max) + (x3max * s3)))
+    else:
+        return x3max * math.sqrt(s3)
+
+@njit(**_JIT_OPTIONS)
+def _qrfac(n, a, ipvt, rdiag, acnorm, wa):
+    """
+    QR factorization of the Jacobian with column pivoting, as lm_qrfac
+
+    ``a`` is [n, m], i.e. stored by column of the Jacobian as in lmmin
+    """
+    m = a.shape[1]
+    for j in range(n):
+        acnorm[j] = _enorm(a[j])
+        rdiag[j] = acnorm[j]
+        wa[j] = rdiag[j]
+        ipvt[j] = j
+
+    for j in range(_min(m, n)):
+        # Bring the column of largest norm into the pivot position
+        kmax = j
+        for k in range(j+1, n):
+            if rdiag[k] > rdiag[kmax]:
+                kmax = k
+        if kmax != j:
+            for i in range(m):
+                a[j, i], a[kmax, i] = a[kmax, i], a[j, i]
+            rdiag[kmax] = rdiag[j]
+            wa[kmax] = wa[j]
+            ipvt[j], ipvt[kmax] = ipvt[kmax], ipvt[j]
+
+        # Householder transformation to reduce the j-th column to a multiple of the j-th unit vector
+        ajnorm = _enorm(a[j, j:])
+        if ajnorm == 0:
+            rdiag[j] = 0
+            continue
+        if a[j, j] < 0:
+            ajnorm = -ajnorm
+        for i in range(j, m):
+            a[j, i] /= ajnorm
+        a[j, j] += 1
+
+        # Apply the transformation to the remaining columns and update the norms
+        for k in range(j+1, n):
+            total = 0.0
+            for i in range(j, m):
+                total += a[j, i] * a[k, i]
+            temp = total / a[j, j]
+            for i in range(j, m):
+                a[k, i] -= temp * a[j, i]
+            if rdiag[k] != 0:
+                temp = a[k, j] / rdiag[k]
+                temp = _max(0.0, 1 - temp * temp)
+                rdiag[k] *= math.sqrt(temp)
+                temp = rdiag[k] / wa[k]
+                if 0.05 * temp * temp <= _MACHEP:
+                    rdiag[k] = _enorm(a[k, j+1:])
+                    wa[k] = rdiag[k]
+        rdiag[j] = -ajnorm
+
+@njit(**_JIT_OPTIONS)
+def _qrsolv(n, r, ipvt, diag, qtb, x, sdiag, wa):
+    """
+    Solve the least squares problem a.x = b, d.x = 0 given the QR factorization of a, as lm_qrsolv
+    """
+    # Copy r and Q^T.b to preserve input and initialize s
+    for j in range(n):
+        for i in range(j, n):
+            r[j, i] = r[i, j]
+        x[j] = r[j, j]
+        wa[j] = qtb[j]
+
+    # Eliminate the diagonal matrix d using Givens rotations
+    for j in range(n):
+        if diag[ipvt[j]] != 0:
+            for k in range(j, n):
+                sdiag[k] = 0
+            sdiag[j] = diag[ipvt[j]]
+            qtbpj = 0.0
+            for k in range(j, n):
+                if sdiag[k] == 0:
+                    continue
+                if abs(r[k, k]) < abs(sdiag[k]):
+                    cot = r[k, k] / sdiag[k]
+                    sin = 1 / math.sqrt(1 + cot * cot)
+                    cos = sin * cot
+                else:
+                    tan = sdiag[k] / r[k, k]
+                    cos = 1 / math.sqrt(1 + tan * tan)
+                    sin = cos * tan
+                r[k, k] = cos * r[k, k] + sin * sdiag[k]
+                temp = cos * wa[k] + sin * qtbpj
+                qtbpj = -sin * wa[k] + cos * qtbpj
+                wa[k] = temp
+                for i in range(k+1, n):
+                    temp = cos * r[k, i] + sin * sdiag[i]
+                    sdiag[i] = -sin * r[k, i] + cos * sdiag[i]
+                    r[k, i] = temp
+        sdiag[j] = r[j, j]
+        r[j, j] = x[j]
+
+    # Solve the triangular system, obtaining a least squares solution if it is singular
+    nsing = n
+    for j in range(n):
+        if sdiag[j] == 0 and nsing == n:
+            nsing = j
+        if nsing < n:
+            wa[j] = 0
+    for j in range(nsing-1, -1, -1):
+        total = 0.0
+        for i in range(j+1, nsing):
+            total += r[j, i] * wa[i]
+        wa[j] = (wa[j] - total) / sdiag[j]
+
+    for j in range(n):
+        x[ipvt[j]] = wa[j]
+
+@njit(**_JIT_OPTIONS)
+def _lmpar(n, r, ipvt, diag, qtb, delta, par, x, sdiag, aux, xdi):
+    """
+    Determine the Levenberg-Marquardt parameter for the trust region ``delta``, as lm_lmpar
+
+    Returns the new parameter. ``x`` is set to the step and ``xdi`` to diag*x
+    """
+    # Gauss-Newton direction, or a least squares solution if the Jacobian is rank deficient
+    nsing = n
+    for j in range(n):
+        aux[j] = qtb[j]
+        if r[j, j] == 0 and nsing == n:
+            nsing = j
+        if nsing < n:
+            aux[j] = 0
+    for j in range(nsing-1, -1, -1):
+        aux[j] = aux[j] / r[j, j]
+        temp = aux[j]
+        for i in range(j):
+            aux[i] -= r[j, i] * temp
+    for j in range(n):
+        x[ipvt[j]] = aux[j]
+
+    # Accept the Gauss-Newton direction if it is within the trust region
+    for j in range(n):
+        xdi[j] = diag[j] * x[j]
+    dxnorm = _enorm(xdi[:n])
+    fp = dxnorm - delta
+    if fp <= 0.1 * delta:
+        return 0.0
+
+    # Lower bound from the Newton step if the Jacobian is not rank deficient
+    parl = 0.0
+    if nsing >= n:
+        for j in range(n):
+            aux[j] = diag[ipvt[j]] * xdi[ipvt[j]] / dxnorm
+        for j in range(n):
+            total = 0.0
+            for i in range(j):
+                total += r[j, i] * aux[i]
+            aux[j] = (aux[j] - total) / r[j, j]
+        temp = _enorm(aux[:n])
+        parl = fp / delta / temp / temp
+
+    # Upper bound
+    for j in range(n):
+        total = 0.0
+        for i in range(j+1):
+            total += r[j, i] * qtb[i]
+        aux[j] = total / diag[ipvt[j]]
+    gnorm = _enorm(aux[:n])
+    paru = gnorm / delta
+    if paru == 0:
+        paru = _DWARF / _min(delta, 0.1)
+
+    par = _min(_max(par, parl), paru)
+    if par == 0:
+        par = gnorm / dxnorm
+
+    it = 0
+    while True:
+        if par == 0:
+            par = _max(_DWARF, 0.001 * paru)
+        temp = math.sqrt(par)
+        for j in range(n):
+            aux[j] = temp * diag[j]
+        _qrsolv(n, r, ipvt, aux, qtb, x, sdiag, xdi)
+        for j in range(n):
+            xdi[j] = diag[j] * x[j]
+        dxnorm = _enorm(xdi[:n])
+        fp_old = fp
+        fp = dxnorm - delta
+
+        if abs(fp) <= 0.1 * delta or (parl == 0 and fp <= fp_old and fp_old < 0) or it == 10:
+            break
+
+        # Newton correction
+        for j in range(n):
+            aux[j] = diag[ipvt[j]] * xdi[ipvt[j]] / dxnorm
+        for j in range(n):
+            aux[j] = aux[j] / sdiag[j]
+            for i in range(j+1, n):
+                aux[i] -= r[j, i] * aux[j]
+        temp = _enorm(aux[:n])
+        parc = fp / delta / temp / temp
+
+        if fp > 0:
+            parl = _max(parl, par)
+        elif fp < 0:
+            paru = _min(paru, par)
+        par = _max(parl, par + parc)
+        it += 1
+    return par
+
+@njit(**_JIT_OPTIONS)
+def _lm_fit_voxel(model, n_fit, times, y, p10, aif, scan, ub, lb, par, curve, work, pwork, ipvt):
+    """
+    Fit a single voxel using Levenberg-Marquardt, as lm_lmdif with the lm_control_double settings
+
+    ``par`` contains the initial parameters and is updated with the fitted values.
+    ``curve`` is filled with the fitted signal enhancement curve. ``work`` is a
+    (N_PARAMS + 2) x T scratch array, ``pwork`` a 6 x N_PARAMS scratch array and
+    ``ipvt`` an integer array of length N_PARAMS. Returns the sum of squared residuals
+    of the fitted curve.
+    """
+    n = n_fit
+    m = times.shape[0]
+    fjac, fvec, wa4 = work[:n], work[N_PARAMS], work[N_PARAMS+1]
+    diag, qtf, wa1, wa2, wa3, aux = pwork[0], pwork[1], pwork[2], pwork[3], pwork[4], pwork[5]
+    max_fev = _MAX_CALL * (n+1)
+
+    nfev = 0
+    lmpar = 0.0
+    delta = 0.0
+    xnorm = 0.0
+    _evaluate(model, n_fit, times, y, par, p10, aif, scan, ub, lb, fvec)
+    nfev += 1
+    fnorm = _enorm(fvec)
+    done = fnorm <= _DWARF
+    it = 0
+    while not done:
+        # Forward difference Jacobian
+        for j in range(n):
+            temp = par[j]
+            step = _max(_FD_STEP*_FD_STEP, _FD_STEP * abs(temp))
+            par[j] = temp + step
+            _evaluate(model, n_fit, times, y, par, p10, aif, scan, ub, lb, wa4)
+            nfev += 1
+            for i in range(m):
+                fjac[j, i] = (wa4[i] - fvec[i]) / step
+            par[j] = temp
+
+        _qrfac(n, fjac, ipvt, wa1, wa2, wa3)
+
+        if it == 0:
+            # Scale by the norms of the columns of the initial Jacobian
+            for j in range(n):
+                diag[j] = wa2[j]
+                if wa2[j] == 0:
+                    diag[j] = 1
+            for j in range(n):
+                wa3[j] = diag[j] * par[j]
+            xnorm = _enorm(wa3[:n])
+            delta = _STEP_BOUND * xnorm
+            if delta == 0:
+                delta = _STEP_BOUND
+        else:
+            for j in range(n):
+                diag[j] = _max(diag[j], wa2[j])
+
+        # Form Q^T.fvec and store the first n components in qtf
+        for i in range(m):
+            wa4[i] = fvec[i]
+        for j in range(n):
+            temp3 = fjac[j, j]
+            if temp3 != 0:
+                total = 0.0
+                for i in range(j, m):
+                    total += fjac[j, i] * wa4[i]
+                temp = -total / temp3
+                for i in range(j, m):
+                    wa4[i] += fjac[j, i] * temp
+            fjac[j, j] = wa1[j]
+            qtf[j] = wa4[j]
+
+        # Norm of the scaled gradient
+        gnorm = 0.0
+        for j in range(n):
+            if wa2[ipvt[j]] == 0:
+                continue
+            total = 0.0
+            for i in range(j+1):
+                total += fjac[j, i] * qtf[i]
+            gnorm = _max(gnorm, abs(total / wa2[ipvt[j]] / fnorm))
+        if gnorm <= _TOL:
+            break
+
+        ratio = 0.0
+        while ratio < 1.0e-4:
+            lmpar = _lmpar(n, fjac, ipvt, diag, qtf, delta, lmpar, wa1, wa2, aux, wa3)
+            for j in range(n):
+                wa2[j] = par[j] - wa1[j]
+            pnorm = _enorm(wa3[:n])
+            if nfev <= 1+n:
+                delta = _min(delta, pnorm)
+
+            # Evaluate at the trial parameters
+            _evaluate(model, n_fit, times, y, wa2, p10, aif, scan, ub, lb, wa4)
+            nfev += 1
+            fnorm1 = _enorm(wa4)
+
+            # Scaled actual and predicted reduction and the scaled directional derivative
+            if 0.1 * fnorm1 < fnorm:
+                actred = 1 - (fnorm1 / fnorm) * (fnorm1 / fnorm)
+            else:
+                actred = -1.0
+            for j in range(n):
+                wa3[j] = 0
+                for i in range(j+1):
+                    wa3[i] -= fjac[j, i] * wa1[ipvt[j]]
+            temp1 = _enorm(wa3[:n]) / fnorm
+            temp2 = math.sqrt(lmpar) * pnorm / fnorm
+            prered = temp1*temp1 + 2*temp2*temp2
+            dirder = -(temp1*temp1 + temp2*temp2)
+            ratio = actred / prered if prered != 0 else 0.0
+
+            # Update the step bound
+            if ratio <= 0.25:
+                if actred >= 0:
+                    temp = 0.5
+                else:
+                    temp = 0.5 * dirder / (dirder + 0.5 * actred)
+                if 0.1 * fnorm1 >= fnorm or temp < 0.1:
+                    temp = 0.1
+                delta = temp * _min(delta, pnorm / 0.1)
+                lmpar /= temp
+            elif lmpar == 0 or ratio >= 0.75:
+                delta = pnorm / 0.5
+                lmpar *= 0.5
+
+            if ratio >= 1.0e-4:
+                # Successful iteration
+                for j in range(n):
+                    par[j] = wa2[j]
+                    wa2[j] = diag[j] * par[j]
+                for i in range(m):
+                    fvec[i] = wa4[i]
+                xnorm = _enorm(wa2[:n])
+                fnorm = fnorm1
+                it += 1
+
+            # Convergence and termination tests
+            if (fnorm <= _DWARF
+                    or (abs(actred) <= _TOL and prered <= _TOL and 0.5 * ratio <= 1)
+                    or delta <= _TOL * xnorm
+                    or nfev >= max_fev
+                    or (abs(actred) <= _MACHEP and prered <= _MACHEP and 0.5 * ratio <= 1)
+                    or delta <= _MACHEP * xnorm
+                    or gnorm <= _MACHEP):
+                done = True
+                break
+
+    resid = 0.0
+    for i in range(m):
+        fit = _signal(model, times[i], par, p10, aif, scan)
+        curve[i] = fit
+        resid += (y[i] - fit) * (y[i] - fit)
+    return resid
+
+@njit(**_JIT_OPTIONS)
+def _init_params(model, par):
+    """
+    Initial parameter values, as in OptimizeFunction::RandomInitialisation
+    """
+    par[0] = 1.0
+    par[1] = 0.7
+    par[2] = 0.0 if model == 3 else 0.5
+    par[3] = 0.0
+
+@njit(**_JIT_OPTIONS)
+def _fit_one(model, n_fit, times, y, t10, aif, scan, ub, lb, par, curve, work, pwork, ipvt):
+    """
+    Initialise and fit a single voxel. Parameters are rounded to 4 d.p. as in Pkrun2::run
+
+    Pkrun2::run repeats the fit three times and keeps the best, but the initialisation
+    is not actually random so the repeats give the same result and one fit is enough
+    """
+    _init_params(model, par)
+    p10 = scan[3] / t10
+    resid = _lm_fit_voxel(model, n_fit, times, y, p10, aif, scan, ub, lb, par, curve, work, pwork, ipvt)
+    for j in range(N_PARAMS):
+        par[j] = math.floor(par[j]*10000 + 0.5) / 10000
+    return resid
+
+@njit(parallel=True, **_JIT_OPTIONS)
+def _fit_voxels(model, n_fit, times, data, t10, aif, scan, ub, lb, out_idx, params, curves, resid):
+    """
+    Fit all voxels, using a thread per voxel
+
+    The model choice is a compile time constant, so a separate version is compiled
+    (and cached) for each model and the choice of model in ``_signal`` is resolved
+    at compile time rather than on every evaluation
+    """
+    literally(model)
+    for vox in prange(data.shape[0]):
+        work = np.empty((N_PARAMS+2, times.shape[0]))
+        pwork = np.empty((6, N_PARAMS))
+        ipvt = np.empty(N_PARAMS, dtype=np.int64)
+        out = out_idx[vox]
+        resid[out] = _fit_one(model, n_fit, times, data[vox], t10[vox], aif, scan, ub, lb,
+                              params[out], curves[out], work, pwork, ipvt)
+
+def _run_constants(aif, scan):
+    """
+    Add values which are the same for every voxel and time point to the AIF and scan
+    parameters so they are not recalculated for every evaluation of the model
+
+    :return: AIF parameters with the Orton AIF change time 2*pi/m1 and f(tB, m2, m1) appended,
+             scan parameters with cos(flip angle) appended
+    """
+    t_b = 2*_PI / aif[2]
+    aif = np.append(aif, (t_b, _orton_f(t_b, aif[3], aif[2])))
+    scan = np.append(scan, math.cos(scan[2]*_PI/180))
+    return aif, scan
+
+def lm_fit_batch(model, times, data, t10, aif, scan, ub, lb, out_idx, params, curves, resid):
+    """
+    Fit a batch of voxels in parallel
+
+    Single precision data is converted to double precision as it is read, so the fit
+    and its accumulators are always double precision
+
+    :param model: Model choice (1-4, see ``MODELS``)
+    :param times: Time points in minutes [T]
+    :param data: Signal enhancement curves [N, T], float32 or float64
+    :param t10: T10 values [N], float32 or float64
+    :param aif: AIF parameters (a1, a2, m1, m2, injection time in minutes)
+    :param scan: R1, R2, flip angle (degrees), TR (s), TE (s) and dose
+    :param ub: Parameter upper bounds [N_PARAMS]
+    :param lb: Parameter lower bounds [N_PARAMS]
+    :param out_idx: Row of the output arrays to write the results for each voxel to [N]
+    :param params: Output array for fitted parameters (Ktrans, ve, offset, vp) [M, N_PARAMS]
+    :param curves: Output array for fitted signal enhancement curves [M, T], float32 or float64
+    :param resid: Output array for sum of squared residuals [M]
+    """
+    n_fit = MODELS[model][1]
+    aif, scan = _run_constants(aif, scan)
+    _fit_voxels(model, n_fit, times, data, t10, aif, scan, ub, lb, out_idx, params, curves, resid)
+
+@njit(cache=True)
+def prepare_data(img, roi_idx, n_baseline, out, baseline):
+    """
+    Extract the ROI voxels from a 4D DCE image and convert them to signal enhancement
+
+    Masking, conversion to float, baseline calculation and normalisation are done
+    in a single pass over the data. The arithmetic is done in double precision and
+    rounded once on storing, as in the Numpy fallback in ``PkModellingProcess.run``.
+    The results agree apart from the last bit of the occasional value, as Numpy
+    sums the baseline in a different order for more than 8 baseline points. It runs in the main process before the worker
+    pool is forked so is not parallel - Numba's threading layers are not fork safe
+    once started.
+
+    :param img: 4D DCE data, any numeric type and memory layout
+    :param roi_idx: Flat (C order) indices of the ROI voxels in the 3D volume [N]
+    :param n_baseline: Number of initial time points to average for the baseline
+    :param out: Output array for signal enhancement curves [N, T]
+    :param baseline: Output array for baseline signal, indexed by flat voxel index
+    """
+    ny, nz, nt = img.shape[1], img.shape[2], img.shape[3]
+    for vox in range(roi_idx.shape[0]):
+        src = roi_idx[vox]
+        i, j, k = src // (ny*nz), (src // nz) % ny, src % nz
+        base = 0.0
+        for t in range(n_baseline):
+            base += img[i, j, k, t]
+        base /= n_baseline
+        baseline[src] = base
+        for t in range(nt):
+            out[vox, t] = img[i, j, k, t] / (base + 0.001) - 1
+
+def cuda_available():
+    """
+    :return: True if a CUDA GPU can be used for fitting
+
+    Note that this initializes the CUDA driver so should be called in the worker
+    process rather than before forking. The CUDA simulator does not count as the
+    kernel cannot run in it
+    """
+    if cuda is None or config.ENABLE_CUDASIM:
+        return False
+    try:
+        return cuda.is_available()
+    except Exception: # pylint: disable=broad-except
+        return False
+
+#: Threads per block for the CUDA fit
+CUDA_BLOCK_SIZE = 128
+
+@functools.lru_cache(maxsize=None)
+def _make_fitter_cuda(model):
+    """
+    Create the GPU kernel for a model
+
+    The model choice is a closure constant so each model's kernel is compiled with
+    only that model's code in the residual evaluation. The device functions are the
+    ``@njit`` functions used on the CPU, compiled again by the CUDA target with its
+    own options and maths library, so the results can differ slightly from
+    ``lm_fit_batch``
+    """
+    n_fit = MODELS[model][1]
+
+    @cuda.jit
+    def _fit_voxels_cuda(times, data, t10, aif, scan, ub, lb, params, curves, resid, work, pwork, ipvt):
+        """
+        Fit all voxels on the GPU, using a thread per voxel
+        """
+        vox = cuda.grid(1)
+        if vox < data.shape[0]:
+            resid[vox] = _fit_one(model, n_fit, times, data[vox], t10[vox], aif, scan, ub, lb,
+                                  params[vox], curves[vox], work[vox], pwork[vox], ipvt[vox])
+
+    return _fit_voxels_cuda
+
+def lm_fit_batch_cuda(model, times, data, t10, aif, scan, ub, lb, out_idx, params, curves, resid):
+    """
+    Fit a batch of voxels on the GPU
+
+    Arguments are the same as for ``lm_fit_batch``. On the device the per-voxel arrays
+    are stored in Fortran order, i.e. as [T, N] with the voxel index varying fastest.
+    Each thread fits one voxel so at each time point the threads in a warp access
+    adjacent memory locations and the loads/stores coalesce. Only the fitted voxels
+    are held on the device and are written to the ``out_idx`` rows after copying back.
+    """
+    fit_voxels = _make_fitter_cuda(model)
+    nvoxels = data.shape[0]
+    aif, scan = _run_constants(aif, scan)
+    d_params = cuda.device_array((nvoxels, N_PARAMS), dtype=params.dtype, order="F")
+    d_curves = cuda.device_array(data.shape, dtype=curves.dtype, order="F")
+    d_resid = cuda.device_array(nvoxels, dtype=resid.dtype)
+    # Fit scratch space, which depends on the number of time points so cannot be thread local
+    d_work = cuda.device_array((nvoxels, N_PARAMS+2, times.shape[0]), dtype=np.float64, order="F")
+    d_pwork = cuda.device_array((nvoxels, 6, N_PARAMS), dtype=np.float64, order="F")
+    d_ipvt = cuda.device_array((nvoxels, N_PARAMS), dtype=np.int64, order="F")
+    blocks = (nvoxels + CUDA_BLOCK_SIZE - 1) // CUDA_BLOCK_SIZE
+    fit_voxels[blocks, CUDA_BLOCK_SIZE](cuda.to_device(times), cuda.to_device(np.asfortranarray(data)),
+                                        cuda.to_device(t10), cuda.to_device(aif), cuda.to_device(scan),
+                                        cuda.to_device(ub), cuda.to_device(lb), d_params, d_curves, d_resid,
+                                        d_work, d_pwork, d_ipvt)
+    params[out_idx] = d_params.copy_to_host()
+    curves[out_idx] = d_curves.copy_to_host()
+    resid[out_idx] = d_resid.copy_to_host()
@@ -6,7 +6,11 @@ Copyright (c) 2013-2018 University of Oxford
 
 import sys
 import logging
+import functools
 import traceback
+import multiprocessing
+from queue import Empty
+from multiprocessing import shared_memory
 
 import numpy as np
 
@@ -15,17 +19,151 @@ from quantiphyse.processes import Process
 
 from .pk_model import PyPk
 
+try:
+    from ._lm_numba import lm_fit_batch, lm_fit_batch_cuda, cuda_available, prepare_data, MODELS
+except ImportError:
+    # Numba not available - fall back to the C++ implementation
+    lm_fit_batch, prepare_data = None, None
+
 LOG = logging.getLogger(__name__)
 
-def _run_pk(worker_id, queue, data, t1, r1, r2, delt, injt, tr1, te1, dce_flip_angle, dose, model_choice):
+#: Maximum number of progress messages per worker to take from the queue on each timeout
+MAX_QUEUE_DRAIN = 16
+
+#: Number of chunks of voxels to fit per CPU with the C++ fit. Using more chunks than CPUs
+#: balances the load when some chunks take longer to fit than others
+WORKERS_PER_CPU = 4
+
+#: Minimum number of voxels in each chunk
+MIN_WORKER_VOXELS = 256
+
+def _create_shared(shape, dtype):
+    """
+    Create a shared memory block and a Numpy array which uses it as its buffer
+
+    :return: Tuple of SharedMemory object, Numpy array
+    """
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    shm = shared_memory.SharedMemory(create=True, size=max(1, nbytes))
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+def _shared_desc(shm, arr):
+    """
+    :return: Pickleable description of a shared memory array for passing to a worker
+    """
+    return shm.name, arr.shape, arr.dtype.str
+
+def _attach_shared(desc):
     """
-    Simple function to run the c++ pk modelling code. Must be a function to work with multiprocessing
+    Attach to a shared memory array created in another process
+
+    :param desc: Description from ``_shared_desc``
+    :return: Tuple of SharedMemory object, Numpy array
+    """
+    name, shape, dtype = desc
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+def _fit_numba(worker_id, queue, data, t1, times, ub, lb, r1, r2, dce_flip_angle, dce_TR, dce_TE, dose, model_choice,
+               injtmins, out_idx, params, fcurve, res, gpu=False):
+    """
+    Run the Numba implementation of the Pk modelling fit in blocks, reporting progress after each
+
+    The fit runs on the GPU if ``gpu`` is True and CUDA is available, otherwise in parallel
+    on the CPU
+    """
+    if model_choice not in MODELS:
+        raise QpException("Unknown model choice: %s" % str(model_choice))
+    desc, _, aif = MODELS[model_choice]
+    log = desc + " \n"
+    if gpu and cuda_available():
+        log += "Fitting on GPU\n"
+        fit_batch = lm_fit_batch_cuda
+    else:
+        fit_batch = lm_fit_batch
+    aif = np.array(aif + (injtmins,))
+    scan = np.array([r1, r2, dce_flip_angle, dce_TR, dce_TE, dose], dtype=np.double)
+    ub, lb = np.array(ub, dtype=np.double), np.array(lb, dtype=np.double)
+
+    size_tot = data.shape[0]
+    size_step = max(1, size_tot // 5)
+    steps = (size_tot + size_step - 1) // size_step
+    log += "Number of voxels per step: %i\n" % size_step
+    log += "Number of steps: %i\n" % steps
+    queue.put((worker_id, 1))
+    for start in range(0, size_tot, size_step):
+        if start > 0:
+            queue.put((worker_id, float(start) / size_tot * 100))
+        end = min(start + size_step, size_tot)
+        fit_batch(model_choice, times, data[start:end], t1[start:end], aif, scan, ub, lb,
+                  out_idx[start:end], params, fcurve, res)
+        log += "Pixel num %i/%i\n" % (end-1, size_tot)
+    return log
+
+def _fit_cpp(worker_id, queue, data, t1, times, ub, lb, r1, r2, dce_flip_angle, dce_TR, dce_TE, dose, model_choice,
+             injtmins, out_idx, params, fcurve, res):
+    """
+    Run the C++ implementation of the Pk modelling fit
+    """
+    Pkclass = PyPk(times, data, t1)
+    Pkclass.set_bounds(ub, lb)
+    Pkclass.set_parameters(r1, r2, dce_flip_angle, dce_TR, dce_TE, dose)
+
+    # Initialise fitting
+    # Choose model type and injection time
+    log = Pkclass.rinit(model_choice, injtmins).decode('utf-8')
+
+    # Process the voxels in steps of about a fifth of the total. Each call to run()
+    # after the first fits the next size_step voxels, so this many steps are needed
+    # to fit all of them
+    size_tot = data.shape[0]
+    size_step = max(1, size_tot // 5)
+    steps1 = (size_tot + size_step - 1) // size_step
+
+    log += "Number of voxels per step: %i\n" % size_step
+    log += "Number of steps: %i\n" % steps1
+    queue.put((worker_id, 1))
+    for ii in range(steps1):
+        if ii > 0:
+            progress = float(ii) / steps1 * 100
+            queue.put((worker_id, progress))
+
+        log += Pkclass.run(size_step).decode('utf-8')
+
+    # Get outputs
+    res[out_idx] = Pkclass.get_residual()
+    fcurve[out_idx] = Pkclass.get_fitted_curve()
+    params[out_idx] = Pkclass.get_parameters()
+    return log
+
+def _run_pk(worker_id, queue, shared, rows, t1, roi_idx, r1, r2, delt, injt, tr1, te1, dce_flip_angle, dose,
+            model_choice, gpu):
+    """
+    Simple function to run the pk modelling code. Must be a function to work with multiprocessing
+
+    The Numba implementation is used if available, otherwise the C++ implementation. If
+    ``gpu`` is True the Numba fit runs on a CUDA GPU if there is one
+
+    The signal enhancement data and the outputs (parameters, fitted curves and residuals) are
+    passed in shared memory rather than pickled - ``shared`` contains the description of
+    each array. This worker fits the data rows in the range ``rows``. The outputs cover the
+    whole volume and the result for each voxel is written to the row given by ``roi_idx``.
+    Only the log is returned.
     """
+    shms = []
     try:
+        arrays = []
+        for desc in shared:
+            shm, arr = _attach_shared(desc)
+            shms.append(shm)
+            arrays.append(arr)
+        data, params, fcurve, res = arrays
+        data = data[rows[0]:rows[1]]
+
         log = "PkModelling\n-----------\n"
-        times = np.arange(0, data.shape[-1])*delt
+        times = np.arange(data.shape[-1], dtype=np.float64)*delt
         # conversion to minutes
-        times = times/60.0
+        times /= 60.0
 
         injtmins = injt/60.0
         Dose = dose
@@ -38,48 +176,28 @@ def _run_pk(worker_id, queue, data, t1, r1, r2, delt, injt, tr1, te1, dce_flip_a
         ub = [10, 1, 0.5, 0.5]
         lb = [0, 0.05, -0.5, 0]
 
-        # contiguous array
-        data = np.ascontiguousarray(data, dtype=np.double)
-        t1 = np.ascontiguousarray(t1, dtype=np.double)
-        times = np.ascontiguousarray(times)
+        # Data and T1 arrive as contiguous float32 arrays from PkModellingProcess.run
         if len(data) == 0:
             raise QpException("Pk Modelling - no unmasked data found!")
 
-        Pkclass = PyPk(times, data, t1)
-        Pkclass.set_bounds(ub, lb)
-        Pkclass.set_parameters(r1, r2, dce_flip_angle, dce_TR, dce_TE, Dose)
-
-        # Initialise fitting
-        # Choose model type and injection time
-        log += Pkclass.rinit(model_choice, injtmins).decode('utf-8')
-
-        # Iteratively process 5000 points at a time
-        size_step = max(1, np.around(data.shape[0]/5))
-        size_tot = data.shape[0]
-        steps1 = np.around(size_tot/size_step)
-        num_row = 1.0  # Just a placeholder for the meanwhile
-
-        log += "Number of voxels per step: %i\n" % size_step
-        log += "Number of steps: %i\n" % steps1
-        queue.put((num_row, 1))
-        for ii in range(int(steps1)):
-            if ii > 0:
-                progress = float(ii) / float(steps1) * 100
-                queue.put((num_row, progress))
-
-            log += Pkclass.run(size_step).decode('utf-8')
-
-        # Get outputs
-        res1 = np.array(Pkclass.get_residual())
-        fcurve1 = np.array(Pkclass.get_fitted_curve())
-        params2 = np.array(Pkclass.get_parameters())
+        if lm_fit_batch is not None:
+            fit_fn = functools.partial(_fit_numba, gpu=gpu)
+        else:
+            fit_fn = _fit_cpp
+        log += fit_fn(worker_id, queue, data, t1, times, ub, lb, r1, r2, dce_flip_angle, dce_TR, dce_TE, Dose,
+                      model_choice, injtmins, roi_idx, params, fcurve, res)
 
         # final update to progress bar
-        queue.put((num_row, 100))
-        return worker_id, True, (res1, fcurve1, params2, log)
+        queue.put((worker_id, 100))
+        return worker_id, True, log
     except:
         traceback.print_exc()
-        return worker_id, False, sys.exc_info()[1]
+        # Drop the traceback as its frames hold views of the shared memory
+        return worker_id, False, sys.exc_info()[1].with_traceback(None)
+    finally:
+        arrays = data = params = fcurve = res = None
+        for shm in shms:
+            shm.close()
 
 class PkModellingProcess(Process):
     """
@@ -93,10 +211,14 @@ class PkModellingProcess(Process):
         Process.__init__(self, ivm, worker_fn=_run_pk, **kwargs)
         self.suffix = ""
         self.thresh = 0
-        self.roi = None
+        self.roi_idx = None
         self.baseline = None
         self.grid = None
         self.nvols = 1
+        self._progress = None
+        self._shm = []
+        self._shared = []
+        self.sig_finished.connect(self._free_shared)
         
     def run(self, options):
         data = self.get_data(options)
@@ -121,72 +243,154 @@ class PkModellingProcess(Process):
         TE = options.pop('te')
         FA = options.pop('fa')
         self.thresh = options.pop('ve-thresh')
+        enh_thresh = options.pop('enh-thresh', None)
         Dose = options.pop('dose', 0)
+        gpu = options.pop('gpu', False)
         model_choice = options.pop('model')
 
         # Baseline defaults to time points prior to injection
         baseline_tpts = int(1 + InjT / DelT)
         self.log("First %i time points used for baseline normalisation\n" % baseline_tpts)
-        baseline = np.mean(data.raw()[:, :, :, :baseline_tpts], axis=-1)
+        baseline_tpts = min(baseline_tpts, data.nvols)
 
         self.grid = data.grid
         self.nvols = data.nvols
-        self.roi = roi.raw()
-        data_vec = data.raw()[self.roi > 0]
-        t1_vec = t1.raw()[self.roi > 0]
-        self.baseline = baseline[self.roi > 0]
-
-        # Normalisation of the image - convert to signal enhancement
-        data_vec = data_vec / (np.tile(np.expand_dims(self.baseline, axis=-1), (1, data.nvols)) + 0.001) - 1
+        # Flat indices of the ROI voxels - the mask is only evaluated once
+        roi_mask = roi.raw() > 0
+        self.roi_idx = np.flatnonzero(roi_mask)
+        t1_vec = t1.raw()[roi_mask].astype(np.float32, copy=False)
+
+        # Hand the data to the worker and get the outputs back through shared memory
+        # rather than pickling them. The outputs are whole volumes which the worker
+        # writes into directly. New shared memory is zero-filled so voxels outside
+        # the ROI need no initialisation. The data and model curves are single
+        # precision - the fit itself is done in double precision
+        self._free_shared()
+        nvoxels = roi_mask.size
+        for shape, dtype in (((len(self.roi_idx), self.nvols), np.float32), ((nvoxels, 4), np.float64),
+                             ((nvoxels, self.nvols), np.float32), ((nvoxels,), np.float64)):
+            shm, arr = _create_shared(shape, dtype)
+            self._shm.append(shm)
+            self._shared.append(arr)
+
+        # Normalisation of the image - convert to signal enhancement, writing
+        # straight into the shared input. The baseline is kept for converting the
+        # model curves back and is zero outside the ROI. It has a trailing singleton
+        # axis so it broadcasts against the curves
+        self.baseline = np.zeros(list(self.grid.shape) + [1,])
+        if prepare_data is not None:
+            prepare_data(data.raw(), self.roi_idx, baseline_tpts, self._shared[0], self.baseline.reshape(-1))
+        else:
+            # Normalise in double precision and round to single precision once, as
+            # prepare_data does
+            data_vec = data.raw()[roi_mask]
+            baseline = np.mean(data_vec[:, :baseline_tpts], axis=-1, dtype=np.float64)
+            self.baseline.reshape(-1)[self.roi_idx] = baseline
+            self._shared[0][:] = data_vec / (baseline[:, None] + 0.001) - 1
+
+        # If an enhancement threshold is given, voxels whose signal never rises above
+        # it after the baseline are not fitted and keep zero parameters. By default
+        # all voxels are fitted. The data for the voxels to be fitted is moved to the
+        # start of the shared input
+        fit_idx = self.roi_idx
+        if enh_thresh is not None and baseline_tpts < self.nvols:
+            self.log("Minimum signal enhancement to fit: %g\n" % enh_thresh)
+            data_vec = self._shared[0]
+            fit = data_vec[:, baseline_tpts:].max(axis=1) > enh_thresh
+            nfit = np.count_nonzero(fit)
+            if nfit < len(fit):
+                self.log("%i non-enhancing voxels not fitted\n" % (len(fit) - nfit))
+                if nfit == 0:
+                    # Nothing to fit so no workers are started. The process completes
+                    # when run() returns and the outputs are all zero
+                    self.log("No voxels with signal enhancement above %g - outputs are zero\n" % enh_thresh)
+                    return
+                data_vec[:nfit] = data_vec[fit]
+                self._shared[0] = data_vec[:nfit]
+                t1_vec, fit_idx = t1_vec[fit], fit_idx[fit]
+
+        # The Numba fit is already parallel across the CPUs, or runs on the GPU, so
+        # it is done by a single worker. The single threaded C++ fit is split into
+        # chunks of voxels which are fitted in parallel worker processes
+        if lm_fit_batch is not None:
+            n_workers = 1
+        else:
+            n_workers = max(1, min(WORKERS_PER_CPU * multiprocessing.cpu_count(), len(fit_idx) // MIN_WORKER_VOXELS))
+        self._progress = np.zeros(n_workers)
+
+        shared = [_shared_desc(shm, arr) for shm, arr in zip(self._shm, self._shared)]
+        args = [shared, t1_vec, fit_idx, R1, R2, DelT, InjT, TR, TE, FA, Dose, model_choice, gpu]
+        self.start_bg(args, n_workers=n_workers)
+
+    def split_args(self, n_workers, args):
+        """
+        Split the voxels into chunks for the workers
 
-        args = [data_vec, t1_vec, R1, R2, DelT, InjT, TR, TE, FA, Dose, model_choice]
-        self.start_bg(args)
+        The T1 and ROI index arrays are split as normal. The signal enhancement data is in
+        shared memory so each worker is also given the range of data rows for its chunk
+        """
+        worker_args = Process.split_args(self, n_workers, args)
+        start = 0
+        for chunk_args in worker_args:
+            # Arguments are worker ID, queue, shared memory, T1 chunk, ...
+            end = start + len(chunk_args[3])
+            chunk_args.insert(3, (start, end))
+            start = end
+        return worker_args
 
     def timeout(self, queue):
-        if queue.empty(): return
-        while not queue.empty():
-            _, progress = queue.get()
-        self.sig_progress.emit(float(progress)/100)
+        # Drain with non-blocking gets rather than empty() followed by get() - each
+        # is a round trip to the queue manager process. The drain is bounded so a
+        # chatty worker cannot hold up the timer callback
+        updated = False
+        for _ in range(MAX_QUEUE_DRAIN * len(self._progress)):
+            try:
+                worker_id, progress = queue.get_nowait()
+            except Empty:
+                break
+            self._progress[worker_id] = progress
+            updated = True
+        if updated:
+            self.sig_progress.emit(float(np.mean(self._progress))/100)
 
     def finished(self, worker_output):
         """
         Add output data to the IVM
         """
         if self.status == Process.SUCCEEDED:
-            # Only one worker - get its output
-            var1 = worker_output[0]
-            self.log(var1[3])
-
-            # Params: Ktrans, ve, offset, vp
-            ktrans = np.zeros(self.grid.shape)
-            
-            ktrans[self.roi > 0] = var1[2][:, 0] * (var1[2][:, 0] < 2.0) + 2 * (var1[2][:, 0] > 2.0)
-
-            ve = np.zeros(self.grid.shape)
-            ve[self.roi > 0] = var1[2][:, 1] * (var1[2][:, 1] < 2.0) + 2 * (var1[2][:, 1] > 2.0)
-            ve *= (ve > 0)
-
-            kep = ktrans / (ve + 0.001)
-            kep[np.logical_or(np.isnan(kep), np.isinf(kep))] = 0
-            kep *= (kep > 0)
-            kep = kep * (kep < 2.0) + 2 * (kep >= 2.0)
-
-            offset = np.zeros(self.grid.shape)
-            offset[self.roi > 0] = var1[2][:, 2]
-
-            vp = np.zeros(self.grid.shape)
-            vp[self.roi > 0] = var1[2][:, 3]
-
-            # Convert signal enhancement back to data curve
-            sig = (var1[1] + 1) * (np.tile(np.expand_dims(self.baseline, axis=-1), (1, self.nvols)))
-            estimated = np.zeros(list(self.grid.shape) + [self.nvols,])
-            estimated[self.roi > 0] = sig
-
-            # Thresholding according to upper limit
-            p = np.percentile(ktrans, self.thresh)
-            ktrans[ktrans > p] = p
-            p = np.percentile(kep, self.thresh)
-            kep[kep > p] = p
+            # The worker logs only differ in the chunk sizes so just log the first, and
+            # the number of chunks if there was more than one. There are no workers if
+            # no voxels needed fitting. Outputs are whole volumes in shared memory, zero
+            # outside the ROI and in voxels which were not fitted. The shared memory is
+            # released once we are done so everything added to the IVM must be a copy
+            if worker_output:
+                self.log(worker_output[0])
+            if len(worker_output) > 1:
+                self.log("Voxels fitted in %i parallel chunks\n" % len(worker_output))
+            _, params, fcurve, _ = self._shared
+
+            # Params: Ktrans, ve, offset, vp. These are copied out of shared memory in
+            # one go and the outputs are views of the copy
+            params = params.reshape(list(self.grid.shape) + [4,]).copy()
+            ktrans, ve, offset, vp = [params[..., idx] for idx in range(4)]
+            np.minimum(ktrans, 2.0, out=ktrans)
+            np.clip(ve, 0.0, 2.0, out=ve)
+
+            kep = ve + 0.001
+            np.divide(ktrans, kep, out=kep)
+            np.nan_to_num(kep, copy=False, nan=0.0, posinf=0.0, neginf=0.0)
+            np.clip(kep, 0.0, 2.0, out=kep)
+
+            # Convert signal enhancement back to data curve, leaving zeros outside the ROI
+            estimated = fcurve.reshape(list(self.grid.shape) + [self.nvols,]) + 1
+            estimated *= self.baseline
+
+            # Thresholding according to upper limit. The 100th percentile is the maximum
+            # so there is nothing to do in the default case. fmin leaves the map
+            # unchanged if the percentile is NaN, i.e. the map contains NaNs
+            if self.thresh < 100:
+                np.fmin(ktrans, np.percentile(ktrans, self.thresh), out=ktrans)
+                np.fmin(kep, np.percentile(kep, self.thresh), out=kep)
 
             self.ivm.add(ktrans, name='ktrans' + self.suffix, grid=self.grid, make_current=True)
             self.ivm.add(ve, name='ve' + self.suffix, grid=self.grid)
@@ -194,4 +398,13 @@ class PkModellingProcess(Process):
             self.ivm.add(offset, name='offset' + self.suffix, grid=self.grid)
             self.ivm.add(vp, name='vp' + self.suffix, grid=self.grid)
             self.ivm.add(estimated, name="model_curves" + self.suffix, grid=self.grid)
-            
\ No newline at end of file
+            
+    def _free_shared(self, *_):
+        """
+        Release the shared memory used to communicate with the worker
+        """
+        self._shared = []
+        for shm in self._shm:
+            shm.close()
+            shm.unlink()
+        self._shm = []
@@ -48,7 +48,9 @@ class DceWidget(QpWidget):
         self.options.add("Time between volumes (s)", NumericOption(minval=0, maxval=30, default=12), key="dt")
         self.options.add("Estimated injection time (s)", NumericOption(minval=0, maxval=60, default=30), key="tinj")
         self.options.add("Ktrans/kep percentile threshold", NumericOption(minval=0, maxval=100, default=100), key="ve-thresh")
+        self.options.add("Minimum signal enhancement to fit", NumericOption(minval=0, maxval=1, default=0), key="enh-thresh", checked=True)
         self.options.add("Dose (mM/kg) - preclinical only", NumericOption(minval=0, maxval=5, default=0.6), key="dose", visible=False)
+        self.options.add("Fit on GPU if available", BoolOption(default=False), key="gpu")
 
         models = [
             "Clinical: Toft / OrtonAIF (3rd) with offset",
@@ -128,6 +128,7 @@ kwargs = {
     'author_email' : 'martin.craig@eng.ox.ac.uk',
     'license' : 'Apache-2.0',
     'install_requires' : get_requirements(module_dir),
+    'python_requires' : '>=3.8',
     'packages' : find_packages(),
     'ext_modules' : get_extensions(module_dir),
     'package_data' : get_package_data(module_dir),
@@ -140,8 +141,8 @@ kwargs = {
     'classifiers' : [
         'Development Status :: 3 - Alpha',
         'Intended Audience :: Science/Research',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
         'Topic :: Scientific/Engineering :: Bio-Informatics',
         'License :: OSI Approved :: Apache Software License',
     ],
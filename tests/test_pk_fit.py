@@ -0,0 +1,201 @@
+"""
+Quantiphyse - Check the Numba Pk modelling fit against the C++ implementation
+
+Signal enhancement curves are fitted by both implementations and the
+parameters and residuals compared. The Numba fit follows the same path as
+the C++ fit so they should agree voxel by voxel, not just on average. Data
+generated from each model is used, and also data which is not generated
+from any of the models, where the fit is harder.
+
+The fit modules are loaded directly from the package directory so the
+package ``__init__``, which needs Quantiphyse and Qt, is not imported.
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+
+import os
+import importlib.util
+import importlib.machinery
+import unittest
+
+import numpy as np
+
+PKG_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "quantiphyse_dce")
+
+def _load(name):
+    """
+    Load a module from the package directory without importing the package
+
+    :return: Module, or None if it is not built or its dependencies are not installed
+    """
+    for suffix in importlib.machinery.SOURCE_SUFFIXES + importlib.machinery.EXTENSION_SUFFIXES:
+        path = os.path.join(PKG_DIR, name + suffix)
+        if os.path.exists(path):
+            spec = importlib.util.spec_from_file_location(name, path)
+            module = importlib.util.module_from_spec(spec)
+            try:
+                spec.loader.exec_module(module)
+            except ImportError:
+                return None
+            return module
+    return None
+
+_lm_numba = _load("_lm_numba")
+pk_model = _load("pk_model")
+
+NVOXELS = 100
+NT = 30
+DELT = 12.0
+
+# Scan parameters as passed to the fit functions: R1, R2, flip angle, TR, TE, dose
+SCAN = (3.7, 4.8, 12.0, 4.108/1000.0, 1.832/1000.0, 0.6)
+INJT_MINS = 0.5
+
+UB = [10, 1, 0.5, 0.5]
+LB = [0, 0.05, -0.5, 0]
+
+# Relative tolerance on the residual of each voxel
+COST_RTOL = 1e-6
+
+# Fraction of voxels which must agree. The implementations should agree
+# everywhere but differences in the maths library between platforms could
+# occasionally send a voxel to a different minimum
+MIN_AGREE = 0.95
+
+class FitChecks:
+    """
+    Test data, fits and checks for each model. The test cases define ``_check`` to
+    compare two fits on the data
+    """
+
+    def _model_data(self, model):
+        """
+        Signal enhancement generated from the model with noise added
+
+        :return: Tuple of times (mins), T10 [N], signal enhancement [N, T]
+        """
+        rng = np.random.default_rng(model)
+        times = np.arange(NT) * DELT / 60.0
+        t10 = rng.uniform(0.8, 1.5, NVOXELS)
+        true = np.stack([
+            rng.uniform(0.05, 0.5, NVOXELS),
+            rng.uniform(0.1, 0.6, NVOXELS),
+            rng.uniform(0, 0.2, NVOXELS) * (model != 2),
+            rng.uniform(0, 0.1, NVOXELS) * (model == 4),
+        ], axis=-1)
+        aif = np.array(_lm_numba.MODELS[model][2] + (INJT_MINS,))
+        aif, scan = _lm_numba._run_constants(aif, np.array(SCAN))
+        data = np.array([[_lm_numba._signal(model, t, true[vox], SCAN[3]/t10[vox], aif, scan)
+                          for t in times] for vox in range(NVOXELS)])
+        data += rng.normal(0, 0.01, data.shape)
+        return times, t10, data
+
+    def _ramp_data(self, model):
+        """
+        Signal enhancement from an integer valued signal with a baseline, a linear
+        rise to a plateau after the injection and noise, normalised as in the process
+
+        :return: Tuple of times (mins), T10 [N], signal enhancement [N, T]
+        """
+        rng = np.random.default_rng(100 + model)
+        times = np.arange(NT) * DELT / 60.0
+        t10 = rng.uniform(0.8, 1.5, NVOXELS)
+        baseline = rng.uniform(100, 200, (NVOXELS, 1))
+        start = INJT_MINS + rng.uniform(0, 0.5, (NVOXELS, 1))
+        rise = rng.uniform(0.5, 4, (NVOXELS, 1))
+        ramp = np.clip((times - start) / rise, 0, 1) * rng.uniform(0, 0.6, (NVOXELS, 1))
+        signal = np.round(baseline * (1 + ramp) + rng.normal(0, 2, (NVOXELS, NT)))
+        data = signal / (signal[:, :3].mean(axis=1, keepdims=True) + 0.001) - 1
+        return times, t10, data
+
+    def _fit_numba(self, model, times, t10, data, fit_batch=None):
+        """
+        :param fit_batch: Numba batch fit function, defaults to ``lm_fit_batch``
+        :return: Tuple of fitted parameters [N, 4], residuals [N]
+        """
+        if fit_batch is None:
+            fit_batch = _lm_numba.lm_fit_batch
+        params = np.zeros((NVOXELS, _lm_numba.N_PARAMS))
+        curves = np.zeros((NVOXELS, NT))
+        resid = np.zeros(NVOXELS)
+        aif = np.array(_lm_numba.MODELS[model][2] + (INJT_MINS,))
+        fit_batch(model, times, data, t10, aif, np.array(SCAN), np.array(UB, dtype=np.double),
+                  np.array(LB, dtype=np.double), np.arange(NVOXELS), params, curves, resid)
+        return params, resid
+
+    def _fit_cpp(self, model, times, t10, data):
+        """
+        :return: Tuple of fitted parameters [N, 4], residuals [N]
+        """
+        pk = pk_model.PyPk(times, data, t10)
+        pk.set_bounds(UB, LB)
+        pk.set_parameters(*SCAN)
+        pk.rinit(model, INJT_MINS)
+        pk.run(NVOXELS)
+        return np.array(pk.get_parameters()), np.array(pk.get_residual())
+
+    def _compare(self, model, params, resid, ref_params, ref_resid):
+        """
+        Check a fit reaches at least as good a fit as the reference in each voxel and
+        that the parameters agree
+        """
+        not_worse = resid <= ref_resid * (1 + COST_RTOL)
+        self.assertGreaterEqual(np.mean(not_worse), MIN_AGREE)
+
+        # Only the parameters fitted by the model are compared. The C++ code does
+        # not initialise the others
+        n_fit = _lm_numba.MODELS[model][1]
+        agree = np.all(np.abs(params[:, :n_fit] - ref_params[:, :n_fit]) < 1e-3, axis=1)
+        self.assertGreaterEqual(np.mean(agree), MIN_AGREE)
+
+    def _check_model_data(self, model):
+        self._check(model, *self._model_data(model))
+
+    def _check_ramp_data(self, model):
+        self._check(model, *self._ramp_data(model))
+
+    def test_orton_offset(self):
+        self._check_model_data(1)
+
+    def test_orton(self):
+        self._check_model_data(2)
+
+    def test_weinmann_offset(self):
+        self._check_model_data(3)
+
+    def test_weinmann_offset_vp(self):
+        self._check_model_data(4)
+
+    def test_orton_offset_ramp(self):
+        self._check_ramp_data(1)
+
+    def test_orton_ramp(self):
+        self._check_ramp_data(2)
+
+    def test_weinmann_offset_ramp(self):
+        self._check_ramp_data(3)
+
+    def test_weinmann_offset_vp_ramp(self):
+        self._check_ramp_data(4)
+
+@unittest.skipIf(_lm_numba is None or pk_model is None, "Numba or the C++ extension is not available")
+class PkFitTest(FitChecks, unittest.TestCase):
+    """
+    Compare the Numba and C++ fits for each model
+    """
+
+    def _check(self, model, times, t10, data):
+        self._compare(model, *self._fit_numba(model, times, t10, data), *self._fit_cpp(model, times, t10, data))
+
+@unittest.skipUnless(_lm_numba is not None and _lm_numba.cuda_available(), "No CUDA GPU available")
+class PkFitCudaTest(FitChecks, unittest.TestCase):
+    """
+    Compare the GPU fit with the CPU fit for each model
+    """
+
+    def _check(self, model, times, t10, data):
+        self._compare(model, *self._fit_numba(model, times, t10, data, _lm_numba.lm_fit_batch_cuda),
+                      *self._fit_numba(model, times, t10, data))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+"""
+Quantiphyse - Check the Pk modelling process gives the same output with the Numba and C++ fits
+
+A small synthetic DCE volume is run through PkModellingProcess with the Numba
+fit and again with the C++ fit and Numpy normalisation, as used when Numba is
+not installed. The C++ run is split into several chunks of voxels. This needs
+Quantiphyse, and so Qt, to be installed.
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+
+import unittest
+from unittest import mock
+
+import numpy as np
+
+try:
+    from quantiphyse.data import DataGrid, ImageVolumeManagement
+    from quantiphyse.processes import Process
+    from quantiphyse_dce import process
+except ImportError:
+    process = None
+
+SHAPE = (5, 6, 4)
+NT = 30
+
+# Integer time between volumes and injection time, as may be given in a batch script
+OPTIONS = {
+    "data" : "dce",
+    "roi" : "roi",
+    "t1" : "T10",
+    "r1" : 3.7,
+    "r2" : 4.8,
+    "dt" : 12,
+    "tinj" : 30,
+    "tr" : 4.108,
+    "te" : 1.832,
+    "fa" : 12,
+    "dose" : 0.6,
+    "ve-thresh" : 95,
+}
+
+OUTPUTS = ("ktrans", "ve", "kep", "offset", "vp", "model_curves")
+
+@unittest.skipIf(process is None, "Quantiphyse is not available")
+@unittest.skipIf(process is not None and process.lm_fit_batch is None, "Numba is not available")
+class PkModellingProcessTest(unittest.TestCase):
+    """
+    Compare the process outputs using the Numba and C++ fits
+    """
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        grid = DataGrid(SHAPE, np.identity(4))
+        times = np.arange(NT) * OPTIONS["dt"] / 60.0
+
+        # Baseline signal with a linear rise to a plateau after the injection and noise
+        baseline = rng.uniform(100, 200, SHAPE + (1,))
+        start = OPTIONS["tinj"] / 60.0 + rng.uniform(0, 0.5, SHAPE + (1,))
+        rise = rng.uniform(0.5, 4, SHAPE + (1,))
+        ramp = np.clip((times - start) / rise, 0, 1) * rng.uniform(0, 0.6, SHAPE + (1,))
+        signal = np.round(baseline * (1 + ramp) + rng.normal(0, 2, SHAPE + (NT,))).astype(np.int16)
+
+        self.ivm = ImageVolumeManagement()
+        self.ivm.add(signal, name="dce", grid=grid)
+        self.ivm.add((rng.uniform(size=SHAPE) > 0.3).astype(np.int32), name="roi", grid=grid, roi=True)
+        self.ivm.add(rng.uniform(0.8, 1.5, SHAPE), name="T10", grid=grid)
+
+    def _run(self, model, suffix):
+        """
+        Run the process in this process rather than in worker processes so the
+        module patches apply to the fit
+
+        :return: Process log
+        """
+        proc = process.PkModellingProcess(self.ivm, multiproc=False)
+        proc.execute(dict(OPTIONS, model=model, suffix=suffix))
+        if proc.status != Process.SUCCEEDED:
+            raise proc.exception
+        return proc.get_log()
+
+    def _check(self, model):
+        self._run(model, "numba")
+        with mock.patch.object(process, "lm_fit_batch", None), \
+             mock.patch.object(process, "prepare_data", None), \
+             mock.patch.object(process, "MIN_WORKER_VOXELS", 16):
+            log = self._run(model, "cpp")
+        self.assertIn("parallel chunks", log)
+
+        # vp is only fitted by model 4. The C++ code does not initialise it otherwise
+        outputs = [name for name in OUTPUTS if name != "vp" or model == 4]
+        for name in outputs:
+            np.testing.assert_allclose(self.ivm.data[name + "_numba"].raw(), self.ivm.data[name + "_cpp"].raw(),
+                                       rtol=1e-5, atol=1e-6, err_msg=name)
+
+    def test_orton_offset(self):
+        self._check(1)
+
+    def test_orton(self):
+        self._check(2)
+
+    def test_weinmann_offset(self):
+        self._check(3)
+
+    def test_weinmann_offset_vp(self):
+        self._check(4)
+
+if __name__ == '__main__':
+    unittest.main()